@@ -13,8 +13,10 @@ References
     Advances in Neural Information Processing Systems 33, NeurIPS 2020.
 """
 
+from __future__ import annotations
+
 import warnings
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import torch
 from botorch.models.multitask import MultiTaskGP
@@ -25,6 +27,7 @@ from gpytorch.constraints import Interval
 from gpytorch.kernels.rbf_kernel import RBFKernel
 from gpytorch.likelihoods.likelihood import Likelihood
 from gpytorch.module import Module
+from gpytorch.settings import detach_test_caches
 from linear_operator.operators import LinearOperator
 from torch import Tensor
 from torch.nn import ModuleList
@@ -105,37 +108,68 @@ class LCEMGP(MultiTaskGP):
             input_transform=input_transform,
             outcome_transform=outcome_transform,
         )
-        self.device = train_X.device
         if all_tasks is None:
-            all_tasks_tensor = train_X[:, task_feature].unique()
-            self.all_tasks = all_tasks_tensor.to(dtype=torch.long).tolist()
+            # `unique` already returns the values in sorted order.
+            all_tasks_tensor = torch.unique(
+                train_X[:, task_feature].to(dtype=torch.long), sorted=True
+            )
         else:
-            all_tasks_tensor = torch.tensor(all_tasks, dtype=torch.long)
-            self.all_tasks = all_tasks
-        self.all_tasks.sort()  # These are the context indices.
+            all_tasks_tensor = torch.tensor(
+                all_tasks, dtype=torch.long, device=train_X.device
+            ).sort()[0]
+        # These are the context indices.
+        self.register_buffer("all_tasks", all_tasks_tensor, persistent=False)
 
         if context_cat_feature is None:
-            context_cat_feature = all_tasks_tensor.unsqueeze(-1).to(device=self.device)
-        self.context_cat_feature: Tensor = (
-            context_cat_feature  # row indices = context indices
+            context_cat_feature = self.all_tasks.unsqueeze(-1)
+        # row indices = context indices
+        self.register_buffer(
+            "context_cat_feature",
+            context_cat_feature.to(dtype=torch.long),
+            persistent=False,
+        )
+        self.register_buffer(
+            "context_emb_feature", context_emb_feature, persistent=False
         )
-        self.context_emb_feature = context_emb_feature
 
         #  construct emb_dims based on categorical features
         if embs_dim_list is None:
             #  set embedding_dim = 1 for each categorical variable
-            embs_dim_list = [1 for _i in range(context_cat_feature.size(1))]
+            embs_dim_list = [1 for _i in range(self.context_cat_feature.size(1))]
         n_embs = sum(embs_dim_list)
-        self.emb_dims = [
-            (len(context_cat_feature[:, i].unique()), embs_dim_list[i])
-            for i in range(context_cat_feature.size(1))
-        ]
+        # The categorical features are used as embedding indices, so each
+        # table needs one row for each value in `0, ..., max`.
+        num_embs = (self.context_cat_feature.amax(dim=0) + 1).tolist()
+        self.emb_dims = list(zip(num_embs, embs_dim_list))
         # contruct embedding layer: need to handle multiple categorical features
-        self.emb_layers = ModuleList(
-            [
-                torch.nn.Embedding(num_embeddings=x, embedding_dim=y, max_norm=1.0)
-                for x, y in self.emb_dims
-            ]
+        cat_idcs = self.context_cat_feature
+        if len(set(embs_dim_list)) == 1:
+            # With a common embedding dimension, the tables of all categorical
+            # features are stacked into a single table, so that all embeddings
+            # can be looked up at once using offset indices.
+            cat_offsets = torch.tensor([0] + num_embs[:-1]).cumsum(dim=0)
+            cat_idcs = cat_idcs + cat_offsets.to(cat_idcs)
+            self.emb_layers = ModuleList(
+                [
+                    torch.nn.Embedding(
+                        num_embeddings=sum(num_embs),
+                        embedding_dim=embs_dim_list[0],
+                        max_norm=1.0,
+                    )
+                ]
+            )
+        else:
+            self.emb_layers = ModuleList(
+                [
+                    torch.nn.Embedding(num_embeddings=x, embedding_dim=y, max_norm=1.0)
+                    for x, y in self.emb_dims
+                ]
+            )
+        self.register_buffer("_context_cat_idcs", cat_idcs, persistent=False)
+        self.register_buffer(
+            "_context_range",
+            torch.arange(self.context_cat_feature.shape[0]),
+            persistent=False,
         )
         self.task_covar_module_base = RBFKernel(
             ard_num_dims=n_embs,
@@ -143,37 +177,139 @@ class LCEMGP(MultiTaskGP):
                 0.0, 2.0, transform=None, initial_value=1.0
             ),
         )
+        # The context covariance only depends on the model parameters, so it is
+        # cached in eval mode and cleared whenever the parameters may change.
+        self._cached_context_covar: Optional[LinearOperator] = None
+        self._cached_context_covar_flat: Optional[Tensor] = None
+        # Values of the parameters that the cached context covariance was computed
+        # with, used to detect parameter changes in eval mode.
+        self._cached_context_covar_params: Optional[List[Tensor]] = None
+        self._register_load_state_dict_pre_hook(self._clear_context_covar_cache)
+        self._register_load_state_dict_pre_hook(self._stack_legacy_emb_weights)
         self.to(train_X)
 
+    @property
+    def all_tasks_list(self) -> List[int]:
+        r"""The sorted context indices as a list."""
+        return self.all_tasks.tolist()
+
+    def _stack_legacy_emb_weights(
+        self, state_dict: Dict[str, Tensor], prefix: str, *args: Any, **kwargs: Any
+    ) -> None:
+        """Stack the per-feature embedding tables of state dicts saved before the
+        tables of multiple categorical features with a common embedding dimension
+        were stacked into a single embedding layer, see `__init__`.
+        """
+        if len(self.emb_layers) > 1 or len(self.emb_dims) == 1:
+            return
+        keys = [f"{prefix}emb_layers.{i}.weight" for i in range(len(self.emb_dims))]
+        if all(key in state_dict for key in keys):
+            state_dict[keys[0]] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+
+    def _clear_context_covar_cache(self, *args: Any, **kwargs: Any) -> None:
+        """Clear the cached context covariance matrix."""
+        self._cached_context_covar = None
+        self._cached_context_covar_flat = None
+        self._cached_context_covar_params = None
+
+    def _apply(self, fn: Callable[[Tensor], Tensor]) -> LCEMGP:
+        # The cached context covariance would keep its device and dtype.
+        self._clear_context_covar_cache()
+        return super()._apply(fn)
+
+    def _context_covar_params(self) -> List[Tensor]:
+        """The parameters that the context covariance depends on."""
+        return [
+            *self.emb_layers.parameters(),
+            *self.task_covar_module_base.parameters(),
+        ]
+
+    def _context_covar_params_changed(self) -> bool:
+        """Check whether the parameters of the context covariance have changed
+        since the cached context covariance was computed (or if there is none).
+        """
+        params = self._context_covar_params()
+        cached_params = self._cached_context_covar_params
+        return cached_params is None or not (
+            len(params) == len(cached_params)
+            and all(torch.equal(p, q) for p, q in zip(params, cached_params))
+        )
+
+    def train(self, mode: bool = True) -> LCEMGP:
+        # `posterior` calls `eval()` on every call, so the cache is only cleared
+        # when leaving or entering train mode.
+        if mode or self.training:
+            self._clear_context_covar_cache()
+        return super().train(mode=mode)
+
+    def _embedding_idcs(self) -> List[Tensor]:
+        """The indices into each of the embedding layers."""
+        if len(self.emb_layers) == 1:
+            return [self._context_cat_idcs]
+        return list(self._context_cat_idcs.unbind(dim=-1))
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        super().__setstate__(state)
+        self._clear_context_covar_cache()
+
     def _eval_context_covar(self) -> LinearOperator:
         """Obtain the context covariance matrix, a linear operator
         with shape (num_contexts x num_contexts).
 
         This first generates the embedding features for all contexts,
         then evaluates the task covariance matrix with those embeddings
-        to get the task covariance matrix.
+        to get the task covariance matrix. In eval mode, the result is
+        cached (detached) if `detach_test_caches` is on. The cache is
+        recomputed if the embedding or kernel parameters have changed.
         """
-        all_embs = self._task_embeddings()
-        return self.task_covar_module_base(all_embs)
+        if self.training or not detach_test_caches.on():
+            all_embs = self._task_embeddings()
+            return self.task_covar_module_base(all_embs)
+        if self._context_covar_params_changed():
+            self._clear_context_covar_cache()
+            with torch.no_grad():
+                all_embs = self._task_embeddings()
+                self._cached_context_covar = self.task_covar_module_base(
+                    all_embs
+                ).evaluate_kernel()
+                self._cached_context_covar_params = [
+                    p.clone() for p in self._context_covar_params()
+                ]
+        return self._cached_context_covar
+
+    def _eval_context_covar_flat(self) -> Tensor:
+        """Obtain the context covariance matrix flattened to a contiguous tensor
+        of shape (num_contexts * num_contexts). Like the context covariance, this
+        is cached in eval mode.
+        """
+        context_covar = self._eval_context_covar()
+        if context_covar is not self._cached_context_covar:
+            return context_covar.to_dense().reshape(-1)
+        if self._cached_context_covar_flat is None:
+            self._cached_context_covar_flat = (
+                context_covar.to_dense().reshape(-1).contiguous()
+            )
+        return self._cached_context_covar_flat
 
     def _task_embeddings(self) -> Tensor:
         """Generate embedding features for all contexts."""
-        embeddings = [
-            emb_layer(
-                self.context_cat_feature[:, i].to(
-                    dtype=torch.long, device=self.device
-                )  # pyre-ignore
-            )
-            for i, emb_layer in enumerate(self.emb_layers)
-        ]
-        embeddings = torch.cat(embeddings, dim=1)
+        n_contexts = self._context_cat_idcs.shape[0]
+        embeddings = []
+        for emb_layer, idcs in zip(self.emb_layers, self._embedding_idcs()):
+            # In eval mode, this (and the `max_norm` renormalization) only runs
+            # when the cached context covariance is recomputed.
+            emb = emb_layer(idcs)
+            # A single (possibly stacked) table, see `__init__`, returns
+            # embeddings of shape (n_contexts x k x emb_dim).
+            embeddings.append(emb.view(n_contexts, -1))
+        if len(embeddings) == 1:
+            embeddings = embeddings[0]
+        else:
+            embeddings = torch.cat(embeddings, dim=1)
 
         # add given embeddings if any
         if self.context_emb_feature is not None:
-            embeddings = torch.cat(
-                [embeddings, self.context_emb_feature.to(self.device)],
-                dim=1,  # pyre-ignore
-            )
+            embeddings = torch.cat([embeddings, self.context_emb_feature], dim=1)
         return embeddings
 
     def task_covar_module(self, task_idcs: Tensor) -> Tensor:
@@ -186,24 +322,26 @@ class LCEMGP(MultiTaskGP):
         Returns:
             Task covariance matrix of shape (b x n x n).
         """
-        # This is a tensor of shape (num_tasks x num_tasks).
-        covar_matrix = self._eval_context_covar().to_dense()
+        # This is a tensor of shape (num_tasks * num_tasks).
+        covar_flat = self._eval_context_covar_flat()
+        num_tasks = self._context_range.shape[0]
         # Here, we index into the base covar matrix to extract
         # the rows & columns corresponding to the task indices.
-        # First indexing operation picks the rows for each index in
-        # task indices (results in b x n x num_tasks). We then transpose
-        # to make the picked rows into columns (b x num_tasks x n), and
-        # pick the rows again to result in the final covariance matrix.
+        # The (i, j)-th entry of the result is entry (t_i, t_j) of the base
+        # covar matrix, which we pick with a single lookup into the flattened
+        # base covar matrix using the flat indices t_i * num_tasks + t_j.
         # The result is a symmetric tensor of shape (b x n x n).
-        # An alternative implementation could pick the columns directly
-        # by moving the transpose operation into the index of gather,
-        # however, this does not seem to make any noticeable difference.
         base_idx = task_idcs.squeeze(-1)
-        expanded_idx = task_idcs.expand(
-            *([-1] * (task_idcs.dim() - 1)), task_idcs.shape[-2]
-        )
-        return (
-            covar_matrix[base_idx].transpose(-1, -2).gather(index=expanded_idx, dim=-2)
+        if base_idx.shape[-1] == num_tasks and torch.equal(
+            base_idx, self._context_range.expand_as(base_idx)
+        ):
+            # All contexts in order, so the base covar matrix is the result.
+            return covar_flat.view(num_tasks, num_tasks).expand(
+                *base_idx.shape, num_tasks
+            )
+        flat_idx = base_idx.unsqueeze(-1) * num_tasks + base_idx.unsqueeze(-2)
+        return covar_flat.index_select(dim=0, index=flat_idx.reshape(-1)).view(
+            flat_idx.shape
         )
 
     @classmethod
@@ -14,6 +14,7 @@ from botorch.utils.test_helpers import gen_multi_task_dataset
 from botorch.utils.testing import BotorchTestCase
 from gpytorch.distributions import MultitaskMultivariateNormal, MultivariateNormal
 from gpytorch.mlls.exact_marginal_log_likelihood import ExactMarginalLogLikelihood
+from gpytorch.settings import detach_test_caches
 from linear_operator.operators import LinearOperator
 from linear_operator.operators.interpolated_linear_operator import (
     InterpolatedLinearOperator,
@@ -40,6 +41,7 @@ class ContextualMultiOutputTest(BotorchTestCase):
             self.assertIsNone(model.context_emb_feature)
             self.assertIsInstance(model.context_cat_feature, Tensor)
             self.assertEqual(model.context_cat_feature.shape, torch.Size([2, 1]))
+            self.assertEqual(model.context_cat_feature.dtype, torch.long)
             self.assertEqual(len(model.emb_layers), 1)
             self.assertEqual(model.emb_dims, [(2, 1)])
 
@@ -81,6 +83,7 @@ class ContextualMultiOutputTest(BotorchTestCase):
             self.assertIsInstance(model2, LCEMGP)
             self.assertIsInstance(model2, MultiTaskGP)
             self.assertIsNotNone(model2.context_emb_feature)
+            self.assertEqual(model2.context_emb_feature.dtype, dtype)
             self.assertIsInstance(model2.context_cat_feature, Tensor)
             self.assertEqual(model2.context_cat_feature.shape, torch.Size([2, 1]))
             self.assertEqual(len(model2.emb_layers), 1)
@@ -90,6 +93,82 @@ class ContextualMultiOutputTest(BotorchTestCase):
             self.assertIsInstance(embeddings2, Tensor)
             self.assertEqual(embeddings2.shape, torch.Size([2, 3]))
 
+            # test multiple categorical features
+            context_cat_feature = torch.tensor([[0, 1], [1, 0]], device=self.device)
+            for embs_dim_list in ([1, 1], [1, 2]):
+                model3 = LCEMGP(
+                    train_X=train_x,
+                    train_Y=train_y,
+                    task_feature=task_feature,
+                    context_cat_feature=context_cat_feature,
+                    embs_dim_list=embs_dim_list,
+                )
+                self.assertEqual(
+                    model3.emb_dims, [(2, embs_dim_list[0]), (2, embs_dim_list[1])]
+                )
+                embeddings3 = model3._task_embeddings()
+                self.assertEqual(embeddings3.shape, torch.Size([2, sum(embs_dim_list)]))
+                if embs_dim_list[0] == embs_dim_list[1]:
+                    # The tables are stacked into a single embedding layer.
+                    self.assertEqual(len(model3.emb_layers), 1)
+                    weights = [
+                        model3.emb_layers[0].weight[:2],
+                        model3.emb_layers[0].weight[2:],
+                    ]
+                    self.assertEqual(
+                        model3.emb_layers[0].weight.shape, torch.Size([4, 1])
+                    )
+                    # State dicts with separate tables per feature can be loaded.
+                    legacy_state_dict = model3.state_dict()
+                    weight = legacy_state_dict.pop("emb_layers.0.weight")
+                    legacy_state_dict["emb_layers.0.weight"] = weight[:2]
+                    legacy_state_dict["emb_layers.1.weight"] = weight[2:]
+                    model3_loaded = LCEMGP(
+                        train_X=train_x,
+                        train_Y=train_y,
+                        task_feature=task_feature,
+                        context_cat_feature=context_cat_feature,
+                        embs_dim_list=embs_dim_list,
+                    )
+                    model3_loaded.load_state_dict(legacy_state_dict)
+                    self.assertAllClose(model3_loaded.emb_layers[0].weight, weight)
+                else:
+                    # Tables with different embedding dimensions are kept separate.
+                    self.assertEqual(len(model3.emb_layers), 2)
+                    weights = [emb_layer.weight for emb_layer in model3.emb_layers]
+                    for weight, emb_dim in zip(weights, embs_dim_list):
+                        self.assertEqual(weight.shape, torch.Size([2, emb_dim]))
+                expected = torch.cat(
+                    [
+                        weights[0][context_cat_feature[:, 0]],
+                        weights[1][context_cat_feature[:, 1]],
+                    ],
+                    dim=-1,
+                )
+                self.assertAllClose(embeddings3, expected)
+
+            # test non-contiguous categorical values
+            model4 = LCEMGP(
+                train_X=train_x,
+                train_Y=train_y,
+                task_feature=task_feature,
+                context_cat_feature=torch.tensor([[0], [3]], device=self.device),
+            )
+            self.assertEqual(model4.emb_dims, [(4, 1)])
+            self.assertEqual(model4._task_embeddings().shape, torch.Size([2, 1]))
+
+            # test unsorted all_tasks
+            all_tasks = [2, 0, 1]
+            model5 = LCEMGP(
+                train_X=train_x,
+                train_Y=train_y,
+                task_feature=task_feature,
+                all_tasks=all_tasks,
+            )
+            self.assertEqual(all_tasks, [2, 0, 1])
+            self.assertEqual(model5.all_tasks_list, [0, 1, 2])
+            self.assertEqual(model5.context_cat_feature.view(-1).tolist(), [0, 1, 2])
+
             # Check task_covar_matrix against previous implementation.
             task_idcs = torch.randint(
                 low=0, high=2, size=torch.Size([8, 32, 1]), device=self.device
@@ -101,6 +180,96 @@ class ContextualMultiOutputTest(BotorchTestCase):
                 right_interp_indices=task_idcs,
             ).to_dense()
             self.assertAllClose(previous_covar, model.task_covar_module(task_idcs))
+            self.assertAllClose(
+                previous_covar[0], model.task_covar_module(task_idcs[0])
+            )
+            # all contexts in order return the context covariance matrix
+            task_idcs = torch.arange(2, device=self.device).expand(3, 2).unsqueeze(-1)
+            self.assertAllClose(
+                model.task_covar_module(task_idcs),
+                covar_matrix.to_dense().expand(3, 2, 2),
+            )
+
+            # test caching of the context covariance in eval mode
+            model.eval()
+            context_covar = model._eval_context_covar()
+            self.assertIs(model._eval_context_covar(), context_covar)
+            self.assertFalse(context_covar.requires_grad)
+            context_covar_flat = model._eval_context_covar_flat()
+            self.assertIs(model._eval_context_covar_flat(), context_covar_flat)
+            self.assertAllClose(context_covar_flat, context_covar.to_dense().view(-1))
+            model.eval()
+            self.assertIs(model._eval_context_covar(), context_covar)
+            with detach_test_caches(False):
+                self.assertIsNot(model._eval_context_covar(), context_covar)
+            model.load_state_dict(model.state_dict())
+            self.assertIsNone(model._cached_context_covar)
+            model._eval_context_covar()
+            self.assertIsNotNone(model._cached_context_covar)
+            model.train()
+            self.assertIsNone(model._cached_context_covar)
+            self.assertIsNone(model._cached_context_covar_flat)
+            self.assertIsNot(model._eval_context_covar(), context_covar)
+            self.assertIsNone(model._cached_context_covar)
+
+            # changing parameters in eval mode recomputes the cache
+            model.eval()
+            context_covar = model._eval_context_covar()
+            model.task_covar_module_base.lengthscale = 0.05
+            new_context_covar = model._eval_context_covar()
+            self.assertIsNot(new_context_covar, context_covar)
+            with detach_test_caches(False):
+                expected_covar = model._eval_context_covar().to_dense()
+            self.assertAllClose(new_context_covar.to_dense(), expected_covar)
+            self.assertAllClose(
+                model._eval_context_covar_flat(), expected_covar.view(-1)
+            )
+            self.assertIs(model._eval_context_covar(), new_context_covar)
+
+            # moving the model clears the cache
+            other_dtype = torch.double if dtype == torch.float else torch.float
+            model.to(dtype=other_dtype)
+            self.assertIsNone(model._cached_context_covar)
+            self.assertEqual(model.task_covar_module(task_idcs).dtype, other_dtype)
+            model.to(dtype=dtype)
+            self.assertEqual(model.task_covar_module(task_idcs).dtype, dtype)
+
+    def test_LCEMGP_embedding_renorm(self):
+        _, (train_x, train_y, _) = gen_multi_task_dataset(
+            dtype=torch.double, device=self.device
+        )
+        model = LCEMGP(
+            train_X=train_x,
+            train_Y=train_y,
+            task_feature=0,
+            embs_dim_list=[2],
+        )
+        weight = model.emb_layers[0].weight
+        state_dict = {k: v.clone() for k, v in model.state_dict().items()}
+        with torch.no_grad():
+            weight.fill_(5.0)
+        train_embeddings = model._task_embeddings()
+        self.assertAllClose(
+            train_embeddings.norm(dim=-1), torch.ones_like(weight[:, 0])
+        )
+        # Weights changed in eval mode are renormalized when the context
+        # covariance is recomputed.
+        model.eval()
+        with torch.no_grad():
+            weight.fill_(5.0)
+        context_covar = model._eval_context_covar()
+        self.assertAllClose(weight.norm(dim=-1), torch.ones_like(weight[:, 0]))
+        self.assertAllClose(model._task_embeddings(), train_embeddings)
+        with detach_test_caches(False):
+            self.assertAllClose(
+                context_covar.to_dense(), model._eval_context_covar().to_dense()
+            )
+        # Loading a state dict in eval mode renormalizes the loaded weights.
+        state_dict["emb_layers.0.weight"].fill_(5.0)
+        model.load_state_dict(state_dict)
+        model._eval_context_covar()
+        self.assertAllClose(weight.norm(dim=-1), torch.ones_like(weight[:, 0]))
+        self.assertAllClose(model._task_embeddings(), train_embeddings)
 
     def test_FixedNoiseLCEMGP(self):
         for dtype in (torch.float, torch.double):
@@ -146,7 +315,9 @@ class ContextualMultiOutputTest(BotorchTestCase):
             # Check that the model inputs are valid.
             model = LCEMGP(**model_inputs)
             # Check that the model inputs are as expected.
-            self.assertEqual(model.all_tasks, [0, 1])
+            self.assertEqual(model.all_tasks.dtype, torch.long)
+            self.assertEqual(model.all_tasks.tolist(), [0, 1])
+            self.assertEqual(model.all_tasks_list, [0, 1])
             if skip_task_features_in_datasets:
                 # In this case, the task feature is appended at the end.
                 self.assertAllClose(model_inputs.pop("train_X"), train_x[..., [1, 0]])